@@ -4,6 +4,6 @@ Author: Brent Goode
 Micropython friendly library to create timers that trigger functions
 """
 
-from .micropytimer import check_timers,setup_timer,start_timer,stop_timer,trigger_timer,override_timer_expiration,show_timers
+from .micropytimer import check_timers,setup_timer,start_timer,stop_timer,trigger_timer,override_timer_expiration,force_restart,show_timers
 
 __all__ = ['check_timers','setup_timer','start_timer','stop_timer','trigger_timer','override_timer_expiration', 'force_restart', 'show_timers']
\ No newline at end of file
@@ -6,14 +6,83 @@ Author: Brent Goode
 Micropython friendly library to create timers that trigger functions
 
 """
+import sys
 import time
+from heapq import heappush, heappop, heapify
+
+# module level aliases skip the attribute lookup on time in the polling path
+_time = time.time
+try:
+    _ticks_ms = time.ticks_ms
+    _ticks_add = time.ticks_add
+    _ticks_diff = time.ticks_diff
+    _short_last = _ticks_ms()
+    # heap keys reach at most half a tick period past _short_clock, so
+    # rebasing at a quarter period keeps them all within small ints
+    _short_rebase_at = (_ticks_add(0, -1) + 1) >> 2
+    # ticks wrap at a port dependent period. When it is a power of two, as on
+    # all current ports, ticks_diff() can be inlined as a mask in _short_now()
+    _ticks_max = _ticks_add(0, -1)
+    if _ticks_max & (_ticks_max + 1):
+        _ticks_max = None
+    else:
+        _ticks_half = (_ticks_max + 1) >> 1
+except AttributeError:
+    # not running under micropython, so only LongTimer is usable
+    _ticks_ms = _ticks_add = _ticks_diff = _short_last = _ticks_max = None
+try:
+    # hardware timer callbacks run as interrupts and hand the action over to it
+    from micropython import schedule as _irq_schedule
+except ImportError:
+    _irq_schedule = None
 
 timer_registry = {}
+_short_heap = []    # (due, name) of running ShortTimers, earliest first
+_long_heap = []     # (due, name) of running LongTimers, earliest first
+_short_clock = 0    # milliseconds counted by _short_now(), never wraps around
+_action_cache = {}  # (library, action) -> resolved callable
 
 def check_timers():
-    """Iterates through all registered timers and call their check_timer() fn"""
-    for name, timer in timer_registry.items():
-        timer.check_timer()
+    """
+    Fires every running timer that has expired
+        Returns:
+            the number of milliseconds until the next polled timer expires,
+            or None if none is waiting. Hardware ShortTimers fire on their own
+            and are not counted. The caller's main loop can sleep that long
+            before calling check_timers() again. It may be shorter than needed
+            after a timer is stopped. It is never longer for ShortTimers, but
+            may be up to a second longer for LongTimers when time() counts
+            whole seconds, as under micropython
+    """
+    global _short_clock
+    if _short_heap:
+        now = _short_now()
+        if now > _short_rebase_at:
+            now = _rebase_short_clock()
+        _fire_expired(_short_heap, ShortTimer, now)
+    elif _short_clock:
+        _short_clock = 0 # nothing is keyed on it, so start counting afresh
+    if _long_heap:
+        _fire_expired(_long_heap, LongTimer, _time())
+
+    # computed after the actions above, which may have started other timers
+    wait = None
+    if _short_heap:
+        wait = _short_heap[0][0] - _short_clock + 1
+    if _long_heap:
+        now = _time()
+        due = _long_heap[0][0]
+        if isinstance(now, int):
+            # whole seconds, so a timer due now only fires once time() ticks
+            # over, and waking every millisecond until then would be wasted
+            long_wait = (int(due) + 1 - now) * 1000
+        else:
+            long_wait = int((due - now) * 1000) + 1
+        if wait is None or long_wait < wait:
+            wait = long_wait
+    if wait is not None and wait < 0:
+        wait = 0
+    return wait
 
 def setup_timer(name,timer_def):
     """
@@ -22,18 +91,15 @@ def setup_timer(name,timer_def):
             name: a string with the name of this timer
             timer_def: a dictionary containing the timer's definition
     """
-    if timer_def.get('long'):
-        if isinstance(timer_def.get('long'),str):
-            if timer_def.get('long').lower() == 'false':
-                timer_registry[name] = ShortTimer(timer_def)
-            else:
-                timer_registry[name] = LongTimer(timer_def)        
-        elif timer_def.get('long'):
-            timer_registry[name] = LongTimer(timer_def)        
-        else:
-            timer_registry[name] = ShortTimer(timer_def)
-    else:
-        timer_registry[name] = ShortTimer(timer_def)
+    timer = timer_registry.get(name)
+    if timer is not None:
+        timer.stop()
+    timer_class = LongTimer if _truthy(timer_def.get('long')) else ShortTimer
+    timer = timer_class(name,timer_def)
+    # registered before being armed, so _schedule() sees its heap entry as live
+    timer_registry[name] = timer
+    if _truthy(timer_def.get('running')):
+        timer._arm()
 
 def start_timer(name):
     """
@@ -41,11 +107,7 @@ def start_timer(name):
         Args:
             name: string with the timer name to be started
     """
-    if timer_registry.get(name):
-        timer_registry.get(name).start()
-    else:
-        raise NameError(f'No timer of name {name} in registry. All timers \
-                          should be created using the setup_timer() function')
+    _get_timer(name).start()
 
 def stop_timer(name):
     """
@@ -53,11 +115,7 @@ def stop_timer(name):
         Args:
             name: string with the timer name to be stope
     """
-    if timer_registry.get(name):
-        timer_registry.get(name).stop()
-    else:
-        raise NameError(f'No timer of name {name} in registry. All timers \
-                          should be created using the setup_timer() function')
+    _get_timer(name).stop()
 
 def trigger_timer(name):
     """
@@ -65,12 +123,9 @@ def trigger_timer(name):
         Args:
             name: string with the timer name to be triggered
     """
-    if timer_registry.get(name):
-        timer_registry.get(name).stop()
-        timer_registry.get(name).action()
-    else:
-        raise NameError(f'No timer of name {name} in registry. All timers \
-                          should be created using the setup_timer() function')
+    timer = _get_timer(name)
+    timer.stop()
+    timer._invoke()
   
 
 def override_timer_expiration(name, interval):
@@ -81,16 +136,12 @@ def override_timer_expiration(name, interval):
         interval: time till new expiration in milliseconds if ShortTimer
                   seconds if LongTimer
     """
-    if timer_registry.get(name):
-        timer_registry.get(name).override_expiration(interval)
-    else:
-        raise NameError(f'No timer of name {name} in registry. All timers \
-                          should be created using the setup_timer() function')
+    _get_timer(name).override_expiration(interval)
 
 
 def force_restart():
     """Iterate through all registered timers and restart any that are running"""
-    for name, timer in timer_registry.items():
+    for timer in timer_registry.values():
         if timer.running:
             timer.start()
 
@@ -99,6 +150,153 @@ def show_timers():
     for name, timer in timer_registry.items():
         print(f'{name}:\n',repr(timer))
 
+def _get_timer(name):
+    """
+    Looks up a timer in the registry
+        Args:
+            name: string with the timer name to be found
+    """
+    timer = timer_registry.get(name)
+    if timer is None:
+        raise NameError(f'No timer of name {name} in registry. All timers \
+                          should be created using the setup_timer() function')
+    return timer
+
+def _truthy(value):
+    """
+    Interprets a timer definition flag that may be given as a str, bool or int
+        Args:
+            value: the flag's value. Strings are true unless empty or 'false'
+    """
+    if isinstance(value,str):
+        return value.lower() not in ('', 'false')
+    return bool(value)
+
+def _fire_expired(heap, timer_class, now):
+    """
+    Pops every entry that expired before now off a timer heap and fires it
+        Args:
+            heap: _short_heap or _long_heap
+            timer_class: the class of the timers scheduled in heap
+            now: the current time on the heap's clock
+    """
+    # popped before any action runs, so timers that actions restart with a due
+    # that has already passed wait for the next pass instead of looping here
+    expired = []
+    while heap and heap[0][0] < now:
+        entry = heappop(heap)
+        timer = _live_timer(entry, timer_class)
+        if timer is not None:
+            expired.append((entry[0], timer))
+    for due, timer in expired:
+        # an earlier action in this pass may have stopped or restarted it
+        if timer._due == due:
+            timer._due = None # timers are one shot by default
+            timer._invoke()
+
+def _live_timer(entry, timer_class):
+    """
+    Returns the timer a heap entry belongs to, or None if the entry is stale
+        Args:
+            entry: a (due, name) tuple from _short_heap or _long_heap
+            timer_class: the class of the timers scheduled in that heap
+    """
+    timer = timer_registry.get(entry[1])
+    # entries left behind by stop(), a restart or a new setup_timer()
+    # with the same name no longer match the timer's _due
+    if isinstance(timer, timer_class) and timer._due == entry[0]:
+        return timer
+    return None
+
+def _schedule(heap, timer, due):
+    """
+    Pushes a timer's new due onto its heap. Stopped and restarted timers leave
+    stale entries behind, so the heap is compacted once it holds more than two
+    entries per registered timer. A timer stopped and started again at the
+    same due pushes a duplicate of its live entry, so the compaction also drops
+    duplicates, leaving at most one entry per timer
+        Args:
+            heap: _short_heap or _long_heap
+            timer: the timer being armed
+            due: when the timer expires on the heap's clock
+    """
+    if timer._due == due:
+        return # restarted without moving, its live entry still stands
+    timer._due = due
+    heappush(heap, (due, timer.name))
+    if len(heap) > 2 * len(timer_registry):
+        live = {entry for entry in heap if _live_timer(entry, type(timer))}
+        heap.clear()
+        heap.extend(live)
+        heapify(heap)
+
+def _short_now():
+    """
+    Returns the ShortTimer clock in milliseconds. Unlike ticks_ms() it does not
+    wrap around, so heap entries stay ordered, as long as it is read at least
+    once per half tick period while ShortTimers are running
+    """
+    global _short_clock, _short_last
+    now = _ticks_ms()
+    if _ticks_max is None:
+        _short_clock += _ticks_diff(now, _short_last)
+    else:
+        _short_clock += ((now - _short_last + _ticks_half) & _ticks_max) - _ticks_half
+    _short_last = now
+    return _short_clock
+
+def _bind_args(action, args):
+    """
+    Returns a callable with no arguments that calls action with args, so the
+    dispatch on args happens once instead of every time the timer fires
+        Args:
+            action: the function to be executed when the timer expires
+            args: None, a list or tuple of arguments, or a single argument
+    """
+    if args is None:
+        return action
+    if isinstance(args,(list,tuple)):
+        return lambda: action(*args)
+    return lambda: action(args)
+
+def _rebase_short_clock():
+    """
+    Shifts _short_clock back to 0 and every ShortTimer heap key along with it,
+    so they stay small ints instead of growing into heap allocated long ints.
+    Only called before any entry is popped in a check_timers() pass
+    """
+    global _short_clock
+    offset = _short_clock
+    _short_clock = 0
+    for i in range(len(_short_heap)):
+        due, name = _short_heap[i]
+        _short_heap[i] = (due - offset, name)
+    # hardware timers only match _due against their own callback, not the heap
+    for timer in timer_registry.values():
+        if isinstance(timer, ShortTimer) and timer._hw is None and timer._due is not None:
+            timer._due -= offset
+    return 0
+
+def _resolve_action(library, action):
+    """
+    Imports the function to be triggered by a timer, caching the result
+        Args:
+            library: name of the library or local python file holding action,
+                     or None for the main script
+            action: name of the function to be found in library
+    """
+    key = (library, action)
+    fn = _action_cache.get(key)
+    if fn is None:
+        if library:
+            # the fromlist imports action too if it is a submodule of library
+            module = __import__(library, None, None, (action,))
+        else:
+            module = sys.modules['__main__']
+        fn = getattr(module, action)
+        _action_cache[key] = fn
+    return fn
+
 class Timer():
     """
     A parent class for two other types of timers. Doesn't have a function to 
@@ -107,49 +305,47 @@ class Timer():
 
     Attributes
     ----------
+    name: str
+        The name of this timer in the timer registry
     action: callable
         The function to be executed when the timer expires
     library: str
         The name of the library or local python file where the function to be
-        executed can be found. If a local file do not include .py
+        executed can be found. If a local file do not include .py. Defaults to
+        the main script
     running: bool
         Whether the timer is set. Determines if the timer is checked or not
     args: any
-        Optional. The argument, or arguments if given as a list, for the function
-        given by action.    
-    Methods
-    -------
-    stop()
-        Stops the timer
+        Optional. The argument, or arguments if given as a list or tuple, for the
+        function given by action.    
     """
-    def __init__(self,timer_def):
-        exec(f'from {timer_def.get("library")} import {timer_def.get("action")}')
-        self.action = locals()[timer_def.get('action')]
-        
-        if timer_def.get('running'):
-            if isinstance(timer_def.get('running'),str):
-                if timer_def.get('running').lower() == 'false':
-                    self.running = False
-                else:
-                    self.running = True
-            else:
-                self.running = timer_def.get('running')
-        else:
-            self.running = False
+    __slots__ = ('name','action','args','interval','expiration','_invoke','_due')
 
-        self.args = timer_def.get('args')
+    def __init__(self,name,timer_def):
+        get = timer_def.get
+        action = _resolve_action(get('library'),timer_def['action'])
+        args = get('args')
+        self.name = name
+        self._due = None
+        self.action = action
+        self.args = args
+        self._invoke = _bind_args(action,args)
 
     def __repr__(self):
-        return_string = f' Type:{self.__class__.__name__}\n'
-        return_string +=f'  Is running:{self.running}\n'
-        return_string +=f'  Action:{self.action}\n'
-        return_string +=f'  Interval:{self.interval}\n'
-        return_string +=f'  Expiration:{self.expiration}\n'
-        return return_string
-    
+        return (f' Type:{self.__class__.__name__}\n'
+                f'  Is running:{self.running}\n'
+                f'  Action:{self.action}\n'
+                f'  Interval:{self.interval}\n'
+                f'  Expiration:{self.expiration}\n')
+
+    @property
+    def running(self):
+        """Whether the timer is set, i.e. has a live entry in its heap"""
+        return self._due is not None
+
     def stop(self):
-        """Stops the timer before it expires"""
-        self.running = False
+        """Stops the timer before it expires. Its heap entry is skipped later"""
+        self._due = None
 
 class ShortTimer(Timer):
     """
@@ -170,11 +366,14 @@ class ShortTimer(Timer):
 
     Attributes
     ----------
+    name: str
+        The name of this timer in the timer registry
     action: callable
         The function to be executed when the timer expires
     library: str
         The name of the library or local python file where the function to be
-        executed can be found. If a local file do not include .py
+        executed can be found. If a local file do not include .py. Defaults to
+        the main script
     running: bool
         Whether the timer is set. Determines if the timer is checked or not
     interval: int
@@ -182,8 +381,11 @@ class ShortTimer(Timer):
     expiration: int
         A fixed clock time after an arbitrary zero when the timer will fire
     args: any
-        The argument, or arguments if given as a list, for the function given
-        by action. 
+        The argument, or arguments if given as a list or tuple, for the function
+        given by action. 
+    hardware: bool
+        Optional. Whether the timer is fired by a virtual machine.Timer instead
+        of being polled by check_timers()
     
     Methods
     -------
@@ -191,48 +393,67 @@ class ShortTimer(Timer):
         Stars the timer
     stop()
         Stops the timer before it expires
-    check_timer()
-        Evaluates whether the time has expired. If so timer is stopped and
-        the action is triggered.
     override_expiration(interval: int)
         Overrides previous interval to set expiration to interval milliseconds
         from now.
     """
-    def __init__(self,timer_def):
+    __slots__ = ('_hw',)
+
+    def __init__(self,name,timer_def):
         """
         """
-        if timer_def.get('interval'):
-            self.interval = timer_def.get('interval')
-            self.expiration = time.ticks_add(time.ticks_ms(), self.interval)
+        interval = timer_def.get('interval')
+        if interval:
+            self.interval = interval
+            self.expiration = _ticks_add(_ticks_ms(), interval)
         else:
             self.interval = None
             self.expiration = timer_def.get('expiration')
-        super().__init__(timer_def)
+        if _truthy(timer_def.get('hardware')):
+            import machine
+            self._hw = machine.Timer(-1)
+        else:
+            self._hw = None
+        super().__init__(name,timer_def)
 
     def start(self):
         """Stars the timer with the correct expiation"""
         if self.interval:
-            self.expiration = time.ticks_add(time.ticks_ms(), self.interval)
-        else:
-            self.expiration = self.expiration
-        self.running = True
+            self.expiration = _ticks_add(_ticks_ms(), self.interval)
+        self._arm()
 
-    def check_timer(self):
+    def _arm(self):
         """
-        Evaluates if the time has expired. If so timer is stopped and
-        the action is triggered.
+        Schedules the timer's expiration in the heap checked by check_timers(),
+        or on its machine.Timer if it is a hardware timer
         """
-        now = time.ticks_ms()
-        if time.ticks_diff(now, self.expiration) > 0 and self.running:
-            self.running = False # timers are one shot by default
-            if self.args is not None:
-                if list is type(self.args):
-                   self.action(*self.args)
-                else:
-                    self.action(self.args)
-            else:
-                self.action() # if timer needs to repeat, reset it in the function action
-    
+        due = _short_now() + _ticks_diff(self.expiration, _short_last)
+        if self._hw is None:
+            _schedule(_short_heap, self, due)
+            return
+        self._due = due
+        # the callback is built here since interrupts must not allocate memory
+        fire = self._hw_fire
+        self._hw.init(mode=self._hw.ONE_SHOT, period=max(1, due - _short_clock + 1),
+                      callback=lambda hw: _irq_schedule(fire, due))
+
+    def _hw_fire(self, due):
+        """
+        Fires the timer once its machine.Timer has expired, unless it was
+        stopped or restarted in the meantime
+        Args:
+            due: the _due the machine.Timer was set up for
+        """
+        if self._due == due:
+            self._due = None # timers are one shot by default
+            self._invoke()
+
+    def stop(self):
+        """Stops the timer before it expires"""
+        self._due = None
+        if self._hw is not None:
+            self._hw.deinit()
+
     def override_expiration(self, interval: int):
         """
         Overrides previous interval to set expiration to interval milliseconds 
@@ -240,7 +461,9 @@ class ShortTimer(Timer):
         Args:
             interval: integer number of second from now to expire
         """
-        self.expiration = time.ticks_add(time.ticks_ms(), interval)
+        self.expiration = _ticks_add(_ticks_ms(), interval)
+        if self.running:
+            self._arm()
 
         
 class LongTimer(Timer):
@@ -259,11 +482,14 @@ class LongTimer(Timer):
 
     Attributes
     ----------
+    name: str
+        The name of this timer in the timer registry
     action: callable
         The function to be executed when the timer expires
     library: str
         The name of the library or local python file where the function to be
-        executed can be found. If a local file do not include .py
+        executed can be found. If a local file do not include .py. Defaults to
+        the main script
     running: bool
         Whether the timer is set. Determines if the timer is checked or not
     interval: int
@@ -271,8 +497,8 @@ class LongTimer(Timer):
     expiration: int
         A fixed clock time in seconds since epoch start when the timer will fire
     args: any
-        The argument, or arguments if given as a list, for the function given
-        by action.
+        The argument, or arguments if given as a list or tuple, for the function
+        given by action.
     
     Methods
     -------
@@ -280,47 +506,33 @@ class LongTimer(Timer):
         Stars the timer
     stop()
         Stops the timer before it expires
-    check_timer()
-        Evaluates whether the time has expired. If so timer is stopped and
-        the action is triggered.
     override_expiration(interval: int)
         Overrides previous interval to set expiration to interval seconds 
         from now.
     """
-    def __init__(self,timer_def):
+    __slots__ = ()
+
+    def __init__(self,name,timer_def):
         """
         """
-        if timer_def.get('interval'):
-            self.interval = timer_def.get('interval')
-            self.expiration = time.time() + self.interval
+        interval = timer_def.get('interval')
+        if interval:
+            self.interval = interval
+            self.expiration = _time() + interval
         else:
             self.interval = None
             self.expiration = timer_def.get('expiration')
-        super().__init__(timer_def)
+        super().__init__(name,timer_def)
 
     def start(self):
         """Stars the timer with the correct expiation"""
         if self.interval:
-            self.expiration = time.time() + self.interval
-        else:
-            self.expiration = self.expiration
-        self.running = True
+            self.expiration = _time() + self.interval
+        self._arm()
 
-    def check_timer(self):
-        """
-        Evaluates if the time has expired. If so timer is stopped and
-        the action is triggered.
-        """
-        now = time.time()
-        if now > self.expiration and self.running:
-            self.running = False # timers are one shot by default
-            if self.args is not None:
-                if list is type(self.args):
-                   self.action(*self.args)
-                else:
-                    self.action(self.args)
-            else:
-                self.action() # if timer needs to repeat, reset it in the function action
+    def _arm(self):
+        """Schedules the timer's expiration in the heap checked by check_timers()"""
+        _schedule(_long_heap, self, self.expiration)
 
     def override_expiration(self, interval: int):
         """
@@ -329,4 +541,6 @@ class LongTimer(Timer):
         Args:
             interval: integer number of second from now to expire
         """
-        self.expiration = time.time() + interval
+        self.expiration = _time() + interval
+        if self.running:
+            self._arm()
@@ -0,0 +1,269 @@
+"""
+Tests for micropytimer using a fake micropython ticks clock
+"""
+import importlib
+import sys
+import time
+import types
+
+import pytest
+
+import micropytimer.micropytimer as mt
+
+TICKS_PERIOD = 1 << 30
+
+fired = []
+
+def record(*args):
+    fired.append(args)
+
+class FakeClock():
+    """Stands in for the micropython ticks_* functions and time.time()"""
+    def __init__(self):
+        self.ms = TICKS_PERIOD - 50 # start close to the wraparound
+        self.s = 1000
+
+    def ticks_ms(self):
+        return self.ms
+
+    def advance(self, ms=0, s=0):
+        self.ms = (self.ms + ms) % TICKS_PERIOD
+        self.s += s
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(time, 'ticks_ms', fake.ticks_ms, raising=False)
+    monkeypatch.setattr(time, 'ticks_add',
+                        lambda a, b: (a + b) % TICKS_PERIOD, raising=False)
+    monkeypatch.setattr(time, 'ticks_diff',
+                        lambda a, b: ((a - b + TICKS_PERIOD // 2) % TICKS_PERIOD)
+                                     - TICKS_PERIOD // 2, raising=False)
+    monkeypatch.setattr(time, 'time', lambda: fake.s)
+    importlib.reload(mt) # rebinds the module level aliases to the fake clock
+    fired.clear()
+    yield fake
+    importlib.reload(mt)
+
+class FakeHardwareTimer():
+    """Stands in for a virtual machine.Timer, fired by calling fire()"""
+    ONE_SHOT = 0
+
+    def __init__(self, id):
+        self.id = id
+        self.period = self.callback = None
+
+    def init(self, mode, period, callback):
+        assert mode == self.ONE_SHOT
+        self.period = period
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
+
+@pytest.fixture
+def hardware(clock, monkeypatch):
+    scheduled = []
+    monkeypatch.setitem(sys.modules, 'machine',
+                        types.SimpleNamespace(Timer=FakeHardwareTimer))
+    monkeypatch.setitem(sys.modules, 'micropython', types.SimpleNamespace(
+        schedule=lambda fn, arg: scheduled.append((fn, arg))))
+    importlib.reload(mt) # picks up micropython.schedule
+    yield scheduled
+    monkeypatch.delitem(sys.modules, 'micropython')
+
+def run_scheduled(scheduled):
+    while scheduled:
+        fn, arg = scheduled.pop(0)
+        fn(arg)
+
+def restart_self(name):
+    fired.append((name,))
+    mt.start_timer(name)
+
+def restart_other(name, other):
+    fired.append((name,))
+    mt.start_timer(other)
+
+def timer_def(**kwargs):
+    kwargs.setdefault('library', __name__)
+    return kwargs
+
+def test_interval_timer_fires_once_after_wraparound(clock):
+    mt.setup_timer('a', timer_def(interval=100, action='record', args=[1, 2],
+                                  running=True))
+    clock.advance(100)
+    mt.check_timers()
+    assert fired == []
+    clock.advance(1)
+    mt.check_timers()
+    clock.advance(500)
+    mt.check_timers()
+    assert fired == [(1, 2)]
+
+@pytest.mark.parametrize('long', [False, True])
+def test_restarted_fixed_timer_fires_once_per_pass(clock, long):
+    expiration = clock.s - 1 if long else clock.ms
+    mt.setup_timer('fixed', timer_def(expiration=expiration, long=long,
+                                      action='restart_self', args='fixed',
+                                      running=True))
+    clock.advance(5, 2)
+    for passes in range(1, 4):
+        assert mt.check_timers() == 0
+        assert fired == [('fixed',)] * passes
+
+def test_fixed_timers_restarting_each_other_fire_once_per_pass(clock):
+    mt.setup_timer('a', timer_def(expiration=clock.ms, action='restart_other',
+                                  args=['a', 'b'], running=True))
+    mt.setup_timer('b', timer_def(expiration=clock.ms, action='restart_other',
+                                  args=['b', 'a'], running=True))
+    clock.advance(5)
+    mt.check_timers()
+    assert sorted(fired) == [('a',), ('b',)]
+    for passes in range(3):
+        fired.clear()
+        mt.check_timers()
+        assert len(fired) == 1
+
+def test_timer_stopped_by_earlier_action_in_pass_does_not_fire(clock):
+    mt.setup_timer('stopper', timer_def(interval=5, action='stop_timer',
+                                        library='micropytimer', args='victim',
+                                        running=True))
+    mt.setup_timer('victim', timer_def(interval=6, action='record', running=True))
+    clock.advance(10)
+    mt.check_timers()
+    assert fired == []
+    assert not mt.timer_registry['victim'].running
+
+def test_short_clock_is_rebased_to_stay_in_small_ints(clock):
+    interval = 1 << 26
+    mt.setup_timer('repeat', timer_def(interval=interval, action='restart_self',
+                                       args='repeat', running=True))
+    mt.setup_timer('late', timer_def(interval=3 * interval, action='record',
+                                     args='late', running=True))
+    mt.setup_timer('stale', timer_def(interval=5, action='record', args='stale',
+                                      running=True))
+    mt.stop_timer('stale')
+    for step in range(1, 41):
+        clock.advance(interval // 2 + 1)
+        wait = mt.check_timers()
+        assert 0 <= mt._short_clock <= mt._short_rebase_at
+        assert all(abs(due) < 1 << 29 for due, name in mt._short_heap)
+        assert wait <= interval + 1
+        if step == 6:
+            assert fired.count(('late',)) == 1
+            assert not mt.timer_registry['late'].running
+    assert fired.count(('repeat',)) == 20
+    assert ('stale',) not in fired
+
+def test_short_clock_restarts_when_no_timer_is_scheduled(clock):
+    mt.setup_timer('once', timer_def(interval=1000, action='record', running=True))
+    clock.advance(1001)
+    mt.check_timers()
+    assert fired == [()]
+    assert mt._short_clock > 0
+    mt.check_timers()
+    assert mt._short_clock == 0
+
+def test_wait_reaches_the_pass_that_fires_a_timer(clock):
+    mt.setup_timer('short', timer_def(interval=30, action='record',
+                                      args='short', running=True))
+    wait = mt.check_timers()
+    clock.advance(wait - 1)
+    mt.check_timers()
+    assert fired == []
+    clock.advance(1)
+    assert mt.check_timers() is None
+    assert fired == [('short',)]
+
+def test_long_wait_skips_to_the_next_whole_second(clock):
+    mt.setup_timer('long', timer_def(interval=3, long=True, action='record',
+                                     running=True))
+    assert mt.check_timers() == 4000
+    clock.advance(s=3)
+    assert mt.check_timers() == 1000 # due now, but time() must still tick over
+    assert fired == []
+    clock.advance(s=1)
+    assert mt.check_timers() is None
+    assert fired == [()]
+
+@pytest.mark.parametrize('long', [False, True])
+def test_stop_start_at_same_due_keeps_heap_bounded(clock, long):
+    expiration = clock.s + 10 if long else clock.ms
+    mt.setup_timer('fixed', timer_def(expiration=expiration, long=long,
+                                      action='record', running=True))
+    heap = mt._long_heap if long else mt._short_heap
+    for _ in range(1000):
+        mt.stop_timer('fixed')
+        mt.start_timer('fixed')
+        assert len(heap) <= 2
+    clock.advance(5, 20)
+    mt.check_timers()
+    assert fired == [()]
+
+def test_action_without_library_is_found_in_main_script(clock, monkeypatch):
+    monkeypatch.setattr(sys.modules['__main__'], 'main_action', record,
+                        raising=False)
+    mt.setup_timer('main', {'action': 'main_action', 'args': 'main'})
+    mt.trigger_timer('main')
+    assert fired == [('main',)]
+
+def test_action_can_be_an_unimported_submodule(clock, monkeypatch):
+    import xml
+    monkeypatch.delitem(sys.modules, 'xml.dom', raising=False)
+    monkeypatch.delattr(xml, 'dom', raising=False)
+    assert mt._resolve_action('xml', 'dom') is sys.modules['xml.dom']
+
+def test_tuple_args_are_passed_as_separate_arguments(clock):
+    mt.setup_timer('pair', timer_def(interval=10, action='record', args=(1, 2),
+                                     running=True))
+    clock.advance(11)
+    mt.check_timers()
+    assert fired == [(1, 2)]
+
+def test_trigger_timer_passes_args_and_stops_timer(clock):
+    mt.setup_timer('early', timer_def(interval=10, action='record', args=[1, 2],
+                                      running=True))
+    mt.trigger_timer('early')
+    assert fired == [(1, 2)]
+    assert not mt.timer_registry['early'].running
+    clock.advance(11)
+    mt.check_timers()
+    assert fired == [(1, 2)]
+
+def test_hardware_timer_fires_once_from_scheduled_callback(clock, hardware):
+    mt.setup_timer('hw', timer_def(interval=30, action='record', args='hw',
+                                   hardware=True, running=True))
+    hw = mt.timer_registry['hw']._hw
+    assert hw.period == 31
+    assert mt.check_timers() is None # not polled, so it is not waited for
+    callback = hw.callback
+    callback(hw)
+    assert fired == [] # only runs once micropython gets to the scheduled call
+    run_scheduled(hardware)
+    callback(hw)
+    run_scheduled(hardware)
+    assert fired == [('hw',)]
+    assert not mt.timer_registry['hw'].running
+
+def test_hardware_timer_does_not_fire_after_stop_or_restart(clock, hardware):
+    mt.setup_timer('hw', timer_def(interval=30, action='record', hardware=True,
+                                   running=True))
+    hw = mt.timer_registry['hw']._hw
+    callback = hw.callback
+    mt.stop_timer('hw')
+    assert hw.callback is None
+    callback(hw) # an interrupt that was already pending when it was stopped
+    run_scheduled(hardware)
+    assert fired == []
+    mt.start_timer('hw')
+    callback = hw.callback
+    clock.advance(10)
+    mt.start_timer('hw')
+    assert hw.period == 31
+    callback(hw)
+    run_scheduled(hardware)
+    assert fired == []
+    hw.callback(hw)
+    run_scheduled(hardware)
+    assert fired == [()]